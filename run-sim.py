@@ -1,9 +1,11 @@
 #!/opt/homebrew/bin/python3.10
 
+import os
 import sys
 import itertools
 import subprocess
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 # Make sure logging gets sent to the screen
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)  # Change to warning for pending implementations
@@ -11,58 +13,69 @@ logging.basicConfig(stream=sys.stdout, level=logging.INFO)  # Change to warning
 logger = logging.getLogger(__name__)
 
 # Base sim command
-BASE_COMMAND = ["python3.10", "-m" "src.simulation"]
+BASE_COMMAND = ["python3.10", "-m", "src.simulation"]
 
 # $BASE_COMMAND --answering_population 100 --rep-c1 3 --rep-c2 1 --use-rep True
 
 
+def run_one(args, save_dir, threads):
+    # Run a single simulation configuration; each one is independent so these can run concurrently.
+    #   - threads: numba threads for this simulation, main splits the cores between the concurrent runs
+    env = {**os.environ, "NUMBA_NUM_THREADS": str(threads)}
+    if args[4]:
+        logger.info("Running arg combination: %s", args)
+        subprocess.run([*BASE_COMMAND,
+                        "--answering_population", f"{args[0]}",
+                        "--rep-c1", f"{args[1]}",
+                        "--rep-c2", f"{args[2]}",
+                        "--use-rep",
+                        "--confidence-threshold", "15",
+                        "--fixed-threshold",
+                        "--experience-boost", "0.4",
+                        "--reputation-affinity", f"{args[3]}",
+                        "--questions_per_epoch", "5000",
+                        # "--silence_logging",
+                        "--save_directory", save_dir], check=True, env=env)
+    else:
+        logger.info("Running arg combination: %s", args)
+        subprocess.run([*BASE_COMMAND,
+                        "--answering_population", f"{args[0]}",
+                        "--rep-c1", f"{args[1]}",
+                        "--rep-c2", f"{args[2]}",
+                        "--confidence-threshold", "15",
+                        "--fixed-threshold",
+                        "--experience-boost", "0.4",
+                        "--reputation-affinity", f"{args[3]}",
+                        "--questions_per_epoch", "5000",
+                        # "--silence_logging",
+                        "--save_directory", save_dir], check=True, env=env)
+
+
 def main():
     answering_population = [100]  # [100, 1000]  # , 10000]  # skip 10k for now to run faster.
     rep_c1 = [10]  # [3, 10]  # , 30]
     rep_c2 = [0.1]  # , 0.01]  # , 0.001]  # 1 is way too fast. with 5k q's 0.001 is so slow its almost identical to no rep
     reputation_affinity = [100]  # [1, 10, 100]
-    use_rep = [True, False]
-    components = [answering_population, rep_c1, rep_c2, reputation_affinity, use_rep]
+    rep_on = itertools.product(answering_population, rep_c1, rep_c2, reputation_affinity, [True])
 
-    # Note that we can skip reputation False variations of rep parameters.
-    # - This is bc permutations with varied reputation parameters but rep false doesn't use the rep parameters.
-    # - The whole test set only takes a few minutes to run, so we leave it enabled for simplicity for now.
-    #   It is easier to quickly compare if there are reputation true/false results next to each other.
-    all_combinations = [p for p in itertools.product(*components)]
+    # Skip reputation False variations of rep parameters.
+    # - Permutations with varied reputation parameters but rep false don't use the rep parameters,
+    #   so each answering population only needs a single rep false run.
+    # - The rep parameters are still passed through (first values), so the saved parameters match the logged ones.
+    rep_off = itertools.product(answering_population, [rep_c1[0]], [rep_c2[0]], [reputation_affinity[0]], [False])
+    all_combinations = [p for p in itertools.chain(rep_on, rep_off)]
 
     save_dir = "sim_states/fixed_boost"
 
-    subprocess.run(["mkdir", "-p", save_dir])
-
-    for args in all_combinations:
-
-        if args[4] is True:
-            logger.info("Running arg combination: %s", args)
-            subprocess.run([*BASE_COMMAND,
-                            "--answering_population", f"{args[0]}",
-                            "--rep-c1", f"{args[1]}",
-                            "--rep-c2", f"{args[2]}",
-                            "--use-rep",
-                            "--confidence-threshold", "15",
-                            "--fixed-threshold",
-                            "--experience-boost", "0.4",
-                            "--reputation-affinity", f"{args[3]}",
-                            "--questions_per_epoch", "5000",
-                            # "--silence_logging",
-                            "--save_directory", save_dir])
-        else:
-            logger.info("Running arg combination: %s", args)
-            subprocess.run([*BASE_COMMAND,
-                            "--answering_population", f"{args[0]}",
-                            "--rep-c1", f"{args[1]}",
-                            "--rep-c2", f"{args[2]}",
-                            "--confidence-threshold", "15",
-                            "--fixed-threshold",
-                            "--experience-boost", "0.4",
-                            "--reputation-affinity", f"{args[3]}",
-                            "--questions_per_epoch", "5000",
-                            # "--silence_logging",
-                            "--save_directory", save_dir])
+    os.makedirs(save_dir, exist_ok=True)
+
+    # Each simulation is CPU bound and independent, so run them concurrently instead of serially.
+    #   - at most one process per combination, and the cores are split between them as numba threads
+    #     (the population confidence pass), so a short sweep still uses the whole machine without oversubscribing
+    cpu_count = os.cpu_count() or 1
+    threads = max(1, cpu_count // len(all_combinations))
+    with ProcessPoolExecutor(max_workers=min(cpu_count, len(all_combinations))) as executor:
+        list(executor.map(run_one, all_combinations, itertools.repeat(save_dir), itertools.repeat(threads)))
 
     logger.info("Finished running %s arg combinations", len(all_combinations))
 
@@ -0,0 +1,316 @@
+
+import functools
+import math
+import numpy as np
+from numba import njit, prange
+
+# Numba compiled kernels for the per-question hot loops.
+#   - These operate on the stacked population arrays (see players.PopulationArrays) so that all voters
+#     for a question are handled in one call instead of one python method call each.
+#   - The first call in a process pays the JIT compile cost, cache=True keeps it on disk after that.
+
+
+@functools.lru_cache(maxsize=None)
+def confidence_table(c1, c2, size=4096):
+    # Confidence for every reputation magnitude below size, see calc_confidence
+    #   - magnitudes are sums of integer correctness counts, so the table is exact and replaces exp for them
+    #   - cached and read only, so everything using one config shares one table
+    magnitude = np.arange(size, dtype=np.float64)
+    table = 1.0 + c1*(1.0/(1.0+np.exp(-magnitude*c2))-0.5)
+    table.flags.writeable = False
+    return table
+
+
+@njit(fastmath=True, cache=True)
+def calc_confidence(correct, ctx_idx, c1, c2, table):
+    # Project one reputation row onto the question context and return the confidence value
+    #   correct: net correctness per domain of one entity, ctx_idx: domain indices of the question context
+    #   table: confidence_table(c1, c2), looked up instead of evaluating the sigmoid when the magnitude fits
+    # Negative correctness counts as zero, then s(x) = c1(1/(1+exp(−x·c2))−1/2) on the summed magnitude
+    magnitude = 0
+    for j in range(ctx_idx.shape[0]):
+        c = correct[ctx_idx[j]]
+        if c > 0:
+            magnitude += c
+    if magnitude < table.shape[0]:
+        return table[magnitude]
+    return 1.0 + c1*(1.0/(1.0+math.exp(-magnitude*c2))-0.5)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def population_confidence(correct, ctx_idx, c1, c2, table, out):
+    # calc_confidence for every row of correct (population, domains), written to out
+    for v in prange(correct.shape[0]):
+        out[v] = calc_confidence(correct[v], ctx_idx, c1, c2, table)
+    return out
+
+
+@njit(cache=True)
+def build_alias(weights, prob, alias, small, large):
+    # Vose's alias method tables for drawing index i with probability weights[i]/sum(weights), in O(n)
+    #   - a draw is one uniform u: i = int(u*n), then i if the fraction u*n - i < prob[i], else alias[i]
+    #   - zero weights get prob 0 and are never drawn
+    #   - prob, alias and the small/large work stacks are caller owned, len(weights) each (see alias_tables)
+    # Returns the total weight, 0 if there is nothing to draw
+    n = weights.shape[0]
+    total = 0.0
+    for i in range(n):
+        total += weights[i]
+    if total <= 0:
+        return 0.0
+    n_small = 0
+    n_large = 0
+    for i in range(n):
+        prob[i] = weights[i]*n/total
+        alias[i] = i
+        if prob[i] < 1.0:
+            small[n_small] = i
+            n_small += 1
+        else:
+            large[n_large] = i
+            n_large += 1
+    while n_small > 0 and n_large > 0:
+        n_small -= 1
+        s = small[n_small]
+        g = large[n_large - 1]
+        # The deficit of s is filled from g
+        alias[s] = g
+        prob[g] -= 1.0 - prob[s]
+        if prob[g] < 1.0:
+            n_large -= 1
+            small[n_small] = g
+            n_small += 1
+    # Whatever is left is 1 up to rounding
+    for k in range(n_large):
+        prob[large[k]] = 1.0
+    for k in range(n_small):
+        if weights[small[k]] > 0:
+            prob[small[k]] = 1.0
+    return total
+
+
+@njit(cache=True)
+def alias_tables(n):
+    # (prob, alias, small, large) scratch arrays for build_alias over n weights, allocated once and reused
+    return (np.empty(n, dtype=np.float64), np.empty(n, dtype=np.intp), np.empty(n, dtype=np.intp),
+            np.empty(n, dtype=np.intp))
+
+
+@njit(cache=True)
+def alias_select(weights, contributions, threshold, rands, out_idx, count, available, tables):
+    # Draw indices proportional to weights without replacement until the contributions of the drawn indices
+    # reach threshold, using build_alias tables.
+    #   - drawn indices have their weight zeroed in place and are appended to out_idx[count:]
+    #   - repeats of an already drawn index are rejected, which gives the same distribution as renormalizing
+    #     over the remaining weights; the tables are rebuilt once half the table's weight has been drawn, so at
+    #     least half of all draws are accepted
+    #   - rands are uniform [0, 1) draws; if they run out before finishing, call again with more, passing back
+    #     weights, out_idx and the returned count and available
+    #   - tables: alias_tables(len(weights)), scratch space reused across calls
+    # Returns (count, available, finished), finished once threshold is reached or no weight is left
+    n = weights.shape[0]
+    prob, alias, small, large = tables
+    table_total = build_alias(weights, prob, alias, small, large)
+    remaining = table_total
+    r = 0
+    while available < threshold:
+        if remaining <= 0.5*table_total:
+            table_total = build_alias(weights, prob, alias, small, large)
+            remaining = table_total
+        if table_total <= 0:
+            return count, available, True
+        if r == rands.shape[0]:
+            return count, available, False
+        u = rands[r]*n
+        r += 1
+        i = min(int(u), n - 1)
+        pick = i if u - i < prob[i] else alias[i]
+        if weights[pick] <= 0:
+            # Already drawn
+            continue
+        out_idx[count] = pick
+        count += 1
+        available += contributions[pick]
+        remaining -= weights[pick]
+        weights[pick] = 0
+    return count, available, True
+
+
+@njit(cache=True)
+def partial_shuffle(order, rands):
+    # Partial Fisher–Yates shuffle: for each j < len(rands), swap a uniformly chosen element of order[j:] into
+    # position j, so order[:len(rands)] is a uniform sample without replacement; O(1) per pick, in place
+    n = order.shape[0]
+    for j in range(rands.shape[0]):
+        swap = j + min(int(rands[j]*(n - j)), n - j - 1)
+        tmp = order[j]
+        order[j] = order[swap]
+        order[swap] = tmp
+
+
+@njit(fastmath=True, cache=True)
+def vote_batch(voter_idx, kd_mask, ctx_mask, inv_c, boost, true_out, participation_count, rands, out_votes,
+               out_stake):
+    # Vote of every selected voter of one question, based on c, their probability to align with the MPPO.
+    #   - The bassline c is the inverse_contention of the question (~.5 high contention, ~1 low), experienced
+    #     parties are offset above it by boost
+    #   - Only a vote is reported, not a peer prediction: peer prediction is assumed to give truthful incentives
+    #   voter_idx: population index of each participating voter
+    #   kd_mask: per voter knowledge domain bitmask, ctx_mask: the question's context bitmask
+    #   rands: one uniform [0, 1) draw per voter, drawn in bulk by the caller
+    # Writes the vote and stake of voter_idx[i] to out_votes[i] and out_stake[i].
+    #   - confidences were already computed for selection, see run_question
+    boosted = min(inv_c + boost, 1.0)
+    for i in range(voter_idx.shape[0]):
+        v = voter_idx[i]
+        participation_count[v] += 1
+        # Domain experience raises the chance of aligning with the true outcome
+        if (kd_mask[v] & ctx_mask) != 0:
+            aligned = rands[i] < boosted
+        else:
+            aligned = rands[i] < inv_c
+        # Vote the true outcome when aligned, the opposite otherwise
+        out_votes[i] = aligned == true_out
+        # Stake is uniform for simpler analysis
+        out_stake[i] = 1
+
+
+@njit(fastmath=True, cache=True)
+def tally_votes(votes, conf, stake):
+    # Net reputation and stake weighted vote
+    #   - each vote contributes its weight signed by the vote, +w for True and -w for False, so the outcome is the
+    #     sign of the one total, in a branch free pass the compiler can vectorize
+    net_votes = 0.0
+    for i in range(votes.shape[0]):
+        net_votes += conf[i]*stake[i]*(2*votes[i] - 1)
+    return net_votes
+
+
+@njit(fastmath=True, cache=True)
+def tally_stakes(votes, stake):
+    # tally_votes without reputation, weighted by stake only (i.e. 1 to 1)
+    net_votes = 0
+    for i in range(votes.shape[0]):
+        net_votes += stake[i]*(2*votes[i] - 1)
+    return net_votes
+
+
+@njit(fastmath=True, cache=True)
+def run_question(voter_idx, kd_mask, ctx_mask, ctx_idx, inv_c, boost, true_out, correct, total, confidence,
+                 participation_count, use_rep, rands, out_votes, out_conf, out_stake):
+    # Fused vote, tally and reputation update for one question.
+    #   - Same arguments as vote_batch, plus ctx_idx (domain indices of the question context),
+    #     correct and total (population, domains) and use_rep for the tally weights
+    #   - confidence: per entity confidence for this question (population_confidence), computed
+    #     once for selection and reused here instead of recomputed per voter; not read if use_rep is False
+    # Returns the resolved outcome as 1 (True), 0 (False) or -1 (indeterminate, no reputation update).
+    vote_batch(voter_idx, kd_mask, ctx_mask, inv_c, boost, true_out, participation_count, rands, out_votes,
+               out_stake)
+    # The weighting is picked once per question rather than tested per vote
+    if use_rep:
+        for i in range(voter_idx.shape[0]):
+            out_conf[i] = confidence[voter_idx[i]]
+        net_votes = tally_votes(out_votes, out_conf, out_stake)
+    else:
+        net_votes = tally_stakes(out_votes, out_stake)
+    if net_votes > 0:
+        resolved = 1
+    elif net_votes < 0:
+        resolved = 0
+    else:
+        return -1
+    # Adjust reputation according to votes and resolved outcome, +1 if agreeing, -1 if disagreeing
+    #   - serial: only the selected voters (~threshold many) are touched, too little work for a parallel region
+    for i in range(voter_idx.shape[0]):
+        v = voter_idx[i]
+        increment = 1 if out_votes[i] == (resolved == 1) else -1
+        for j in range(ctx_idx.shape[0]):
+            total[v, ctx_idx[j]] += 1
+            correct[v, ctx_idx[j]] += increment
+    return resolved
+
+
+# Names of the counts returned by run_epoch, in order
+EPOCH_STATS = ("total_aborted", "indeterminate_resolution", "true_positive", "false_positive", "true_negative",
+               "false_negative")
+
+
+@njit
+def run_epoch(rng, start, end, context_start, context_idx, ctx_mask64, contention, true_outcome, req_confidence,
+              aborted, indeterminate_resolution, parties_used, resolved_correctly, kd_mask, correct, total,
+              confidence, participation_count, c1, c2, table, boost, use_rep, fixed_threshold,
+              reputation_affinity, voter_order, selection_buffer, out_votes, out_conf, out_stake):
+    # The question loop of one epoch: selection, voting, tally and reputation update for questions [start, end)
+    #   - question columns are the QuestionPool columns (see QuestionPool.kernel_columns), the results of each
+    #     question are written to its row of aborted, indeterminate_resolution, parties_used and resolved_correctly
+    #   - population arrays are the PopulationArrays ones, table is its confidence_table
+    #   - rng is the simulation's numpy Generator, drawn from directly so runs stay tied to the seed
+    #   - not cached on disk: loading a cached kernel that takes a Generator crashes once more than one
+    #     specialization is cached, so this is compiled per process (the kernels it calls are still cached)
+    #   - voter_order: population indices for uniform selection, shuffled in place, any permutation will do
+    #   - selection_buffer and the out_ buffers are scratch space sized for the whole population
+    # Returns the counts named by EPOCH_STATS
+    population_count = correct.shape[0]
+    unit_contributions = np.ones(population_count)
+    voter_affinity = np.empty(population_count)
+    selection_tables = alias_tables(population_count)
+    total_aborted = 0
+    total_indeterminate = 0
+    # Confusion matrix of resolved questions, indexed [resolved outcome, true outcome]
+    confusion = np.zeros((2, 2), dtype=np.int64)
+    for q in range(start, end):
+        ctx_idx = context_idx[context_start[q]:context_start[q + 1]]
+        threshold = req_confidence[q]
+        # Select who will be voting
+        #   - based on required confidence threshold and current reputation
+        #   - select psuedo randomly weighted by established reputation
+        if use_rep:
+            population_confidence(correct, ctx_idx, c1, c2, table, confidence)
+            # Selection favors high reputation via reputation_affinity, voters with zero affinity are never selected
+            for v in range(population_count):
+                voter_affinity[v] = math.floor(confidence[v]*reputation_affinity)
+            # Contributions are counts with a fixed threshold
+            contributions = unit_contributions if fixed_threshold else confidence
+            # Each contribution is at least 1, so about 2*threshold draws usually suffice; more are taken and the
+            # selection resumed if not
+            #   - capped by the population size, so unreachable thresholds don't allocate huge batches per question
+            draw_count = int(math.ceil(min(4*max(threshold, 0.0), 2.0*population_count))) + 64
+            selected_count, available_reputation, finished = 0, 0.0, False
+            while not finished:
+                selected_count, available_reputation, finished = alias_select(
+                    voter_affinity, contributions, threshold, rng.random(draw_count), selection_buffer,
+                    selected_count, available_reputation, selection_tables)
+            participating_idx = selection_buffer[:selected_count]
+        else:
+            # Uniform selection without replacement, every voter contributes 1 so the count is known up front
+            selected_count = min(population_count, max(0, math.ceil(threshold)))
+            partial_shuffle(voter_order, rng.random(selected_count))
+            available_reputation = float(selected_count)
+            participating_idx = voter_order[:selected_count]
+
+        # If we used everyone and can't meet the threshold, record this and abort.
+        #   - aborted questions are not counted as indeterminate in the stats, as they wouldn't be accepted
+        if available_reputation < threshold:
+            indeterminate_resolution[q] = True
+            aborted[q] = True
+            parties_used[q] = -1
+            total_aborted += 1
+            continue
+        voter_count = participating_idx.shape[0]
+        parties_used[q] = voter_count
+
+        # Vote, tally and adjust reputation (see run_question)
+        resolution = run_question(participating_idx, kd_mask, ctx_mask64[q], ctx_idx, contention[q], boost,
+                                  true_outcome[q], correct, total, confidence, participation_count, use_rep,
+                                  rng.random(voter_count), out_votes[:voter_count], out_conf[:voter_count],
+                                  out_stake[:voter_count])
+        if resolution < 0:
+            indeterminate_resolution[q] = True
+            total_indeterminate += 1
+            continue
+        # Record if resolved outcome is not the presupposed one, and correctness stats for precision/recall
+        resolved_correctly[q] = resolution == true_outcome[q]
+        confusion[resolution, int(true_outcome[q])] += 1
+    # true positive, false positive, true negative, false negative
+    return (total_aborted, total_indeterminate, confusion[1, 1], confusion[1, 0], confusion[0, 0],
+            confusion[0, 1])
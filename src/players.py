@@ -1,15 +1,47 @@
 
-import copy
-import random
 import logging
 import numpy as np
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Iterator, NamedTuple, Optional
+
+from .kernels import confidence_table
 
 logger = logging.getLogger(__name__)
 
 
+def build_domain_index(context_set: dict) -> dict[str, int]:
+    # Assign every domain in the context set a dense integer index so reputation can live in arrays.
+    #   - Primary domains come first, followed by any secondary domains not already seen.
+    domain_to_idx: dict[str, int] = {}
+    for domain in context_set.keys():
+        domain_to_idx.setdefault(domain, len(domain_to_idx))
+    for sub_collection in context_set.values():
+        for domain in sub_collection:
+            domain_to_idx.setdefault(domain, len(domain_to_idx))
+    return domain_to_idx
+
+
+def sample_knowledge_idx(rng: np.random.Generator, population_count: int, domain_count: int, k: int) -> np.ndarray:
+    # k distinct indices in [0, domain_count) for each of population_count entities, as a (population, k) array
+    #   - drawn for the whole population at once, without replacement: the first k of a random permutation per row
+    if k > domain_count:
+        raise ValueError("Sample larger than population")
+    return np.argsort(rng.random((population_count, domain_count)), axis=1)[:, :k]
+
+
+class VoterConfig(NamedTuple):
+    # Parameters shared by every answering entity, one instance is referenced by the whole population
+    # Growth limit in sigmoid reputation function
+    c1: float  # trying 3?
+    # Growth rate in sigmoid reputation function
+    c2: float  # if less than 1, it is very hard to reach threshold. Do (1 + rep) so min rep is 1?
+    # PARAMETER: the probability increase granted by being knowledgable
+    exp_boost: float = 0.1
+
+
 class SimulationEntity(ABC):
+    # Empty slots so subclasses that declare __slots__ don't get a per-instance __dict__
+    __slots__ = ()
 
     @abstractmethod
     def dump_state():
@@ -21,138 +53,216 @@ class SimulationEntity(ABC):
 
 
 class AnsweringEntity(SimulationEntity):
+    __slots__ = ('_domain_to_idx', 'total', 'correct', '_participation_count', 'knowledge_domains',
+                 '_kd_mask')
+
+    def __init__(self,
+                 domain_list: tuple[str, ...],
+                 domain_to_idx: dict[str, int],
+                 experience_domains_count: int = 1,
+                 knowledge_idx: Optional[list[int]] = None,
+                 rng: Optional[np.random.Generator] = None,
+                 rows: Optional[tuple[np.ndarray, np.ndarray, np.ndarray]] = None):
+
+        # Use a pair of dense arrays indexed by domain_to_idx as the reputation for this identity
+        #   - total: votes cast per domain
+        #   - correct: net correctness per domain, +1 for each vote agreeing with the resolution, -1 otherwise
+        #     (so it can go negative, and is not a count of correct votes)
+        #   - rows: (total, correct, participation_count) views into population arrays to use instead,
+        #     see PopulationArrays.generate
+        self._domain_to_idx = domain_to_idx
+        if rows is None:
+            self.total = np.zeros(len(domain_to_idx), dtype=np.int32)
+            self.correct = np.zeros(len(domain_to_idx), dtype=np.int32)
+            # Count of questions this party has participated in
+            #   - a 0-d array so it can become a view into PopulationArrays like the reputation arrays
+            self._participation_count = np.zeros((), dtype=np.int64)
+        else:
+            self.total, self.correct, self._participation_count = rows
 
-    def __init__(self, context_set: dict, c1: float, c2: float, experience_domains_count: int = 1, exp_boost=0.1):
-
-        # Use dictionary as a sparse vector of reputation for this identity
-        #   - Track total contributions and total correct per domain
-        self.sparse_rep: dict[str, tuple[int, int]] = {}  # (total, correct)
-
-        # Count of questions this party has participated in
-        self._participation_count = 0
-
-        # Select experience_domains_count base context from context_set
+        # Select experience_domains_count base context from the primary domains of the context set
         #   - these are primary domains that give a boost in probability of correctness
-        self.knowledge_domains = random.sample(context_set.keys(), k=experience_domains_count)
-        # Growth limit in sigmoid reputation function
-        self._c1 = c1  # trying 3?
-        # Growth rate in sigmoid reputation function
-        self._c2 = c2  # if less than 1, it is very hard to reach threshold. Do (1 + rep) so min rep is 1?
-        # PARAMETER: the probability increase granted by being knowledgable
-        self._experience_boost = exp_boost
-
-    def vote(self, q_context, inverse_contention: float, true_outcome: bool, rep: bool) -> tuple[bool, float, float]:
-        # Choose an outcome based on, c, their inherent probability to align with MPPO for this question.
-        #   - We can view the bassline c as the inverse_contention of the question. (~.5 high contention, ~1 low)
-        #   - Each party will have some offset from this bassline. Experienced parties are assume to have higher.
-        #   - Here we only report a vote and not a peer prediction because we care about the resolution
-        #     process are are assuming that peer prediction produces truthful incentives.
-        # Return (vote, reputation, stake)
-        #  Vote: the proposition vote for this question for this voter
-        #  Reputation: the reputation for this given question context
-        #  Stake: the voting stake contributed, default to 1 for simpler analysis
-        self._participation_count += 1
-        domain_experience = False
+        #   - domain_list is built once by the caller and shared by the population
+        #   - knowledge_idx (positions in domain_list) can be drawn by the caller for the whole population,
+        #     see sample_knowledge_idx, otherwise it is drawn here from rng (normally the simulation's generator)
+        if knowledge_idx is None:
+            rng = rng if rng is not None else np.random.default_rng()
+            knowledge_idx = sample_knowledge_idx(rng, 1, len(domain_list), experience_domains_count)[0].tolist()
+        self.knowledge_domains = [domain_list[i] for i in knowledge_idx]
+        # Bitmask of knowledge domain indices (bit i is domain_to_idx i), used for context overlap checks
+        self._kd_mask = 0
         for domain in self.knowledge_domains:
-            if domain in q_context:
-                domain_experience = True
-        # Vote based on a random float being LESS than the inverse contention (plus boost)
-        #  Consider inverse_contention \in (0.5, 1] centered at ~0.75
-        #   low chance that: random.random() > inverse_contention --> vote opposite true_outcome
-        #   high chance that: random.random() < inverse_contention --> vote true_outcome.
-        # Given the "true answer", select the opposite if voting against (unaligned)
-        if domain_experience:
-            aligned = random.random() < min(inverse_contention + self._experience_boost, 1)
-        else:
-            aligned = random.random() < inverse_contention
-        # We are assuming that everyone has a preferred side.
-        #  - Population level base contention with (imagined) "true value" sets the preferred side
-        #  - Random selection for each party which side to take
-        if not aligned:
-            # Vote against true outcome
-            vote = not true_outcome
-        else:
-            vote = true_outcome
-        if rep:
-            return (vote, self.calculate_confidence(q_context), 1)
-        else:
-            # Return None for rep to ensure this isn't used anywhere.
-            return (vote, None, 1)
-
-    # cache these to avoid a second call?
-    # cache is only valid for one iteration: include question #, epoch # in args?
-    def calculate_confidence(self, question_context, default_rep=1):
-        # Project our reputation onto the question context and return confidence value
-        # - Iterate each context domain in the question
-        # - compute historical correctness (handle negatives?)
-        # - append to list
-        # - Return vector magnitude of this list
-        rep_vector = []
-        relevant_reputation = [self.sparse_rep[c] for c in question_context if c in self.sparse_rep.keys()]
-        for total, correct in relevant_reputation:
-            # Note: Handle negatives? For now just default to zero. (see below)
-            rep_vector.append(max(correct, 0))  # dividing here creates an extra penalty and traps < 1.
-        logger.debug("Reputation vector is: %s", rep_vector)
-        magnitude = np.linalg.norm(rep_vector, ord=1)  # + default_rep  # if len(rep_vector) != 0 else default_rep
-        # Use magnitude to evaluate in the sigmoid s(x) = c1(1/(1+exp(−x·c2))−1/2)
-        #   - could handle negatives if our "projection" method allows it
-        #   - this would permit negative contributions for persistent incorrectness
-        adjusted_rep = self._c1*(1/(1+np.exp(-magnitude*self._c2))-1/2)
-        logger.info("Voting with %s reputation.", 1+adjusted_rep)
-        # NOTE: currently configured to only be able to increase vote weight, not decrease.
-        #   - consider allowing reducing contribution if historically incorrect? needs projection changes
-        #   - how to decide if incorrect enough to deduct instead?
-        #   perhaps, sum of contributions in these domains is incorrect on avg?
-        # breakpoint()
-        return 1 + adjusted_rep
-
-    def update_reputation(self, voted: bool, resolved_outcome: bool, question_context):
-        # Increment +1 if agreeing with true result, -1 if disagreeing
-        if voted is resolved_outcome:
-            increment = +1
-        else:
-            increment = -1
-        for domain in question_context:
-            # (correct votes, all votes) per domain
-            current_rep: tuple = self.sparse_rep.get(domain, (0, 0))
-            self.sparse_rep[domain] = (current_rep[0] + 1, current_rep[1] + increment)
+            self._kd_mask |= 1 << domain_to_idx[domain]
+
+    @property
+    def sparse_rep(self) -> dict[str, tuple[int, int]]:
+        # Sparse {domain: (total, correct)} view of the reputation arrays, only for domains with history
+        #   - this is also the saved "reputation" format, total always comes first
+        #   - domain_to_idx is in index order, the nonzero entries are found and converted in bulk
+        domains = list(self._domain_to_idx)
+        nonzero = np.flatnonzero(self.total)
+        return {
+            domains[i]: (total, correct)
+            for i, total, correct in zip(nonzero.tolist(), self.total[nonzero].tolist(), self.correct[nonzero].tolist())
+            }
 
     def dump_state(self):
         return {
-            "participation_count": self._participation_count,
+            "participation_count": int(self._participation_count),
             "reputation": self.sparse_rep,
             "knowledge_domains": self.knowledge_domains
             }
 
     def load_state(self, state_data: dict):
-        self.sparse_rep = state_data['reputation']
+        self.total[:] = 0
+        self.correct[:] = 0
+        for domain, (total, correct) in state_data['reputation'].items():
+            self.total[self._domain_to_idx[domain]] = total
+            self.correct[self._domain_to_idx[domain]] = correct
         self.knowledge_domains = state_data['knowledge_domains']
-        self._participation_count = state_data['participation_count']
+        self._kd_mask = 0
+        for domain in self.knowledge_domains:
+            self._kd_mask |= 1 << self._domain_to_idx[domain]
+        self._participation_count[...] = state_data['participation_count']
+
+
+class PopulationArrays:
+
+    # Stacked (struct of arrays) numeric state of a whole answering population for the batched kernels.
+    #   - total and correct are (population, domains) in column major (Fortran) order: the per question confidence
+    #     pass reads a few domain columns for every entity, which are then contiguous instead of one cache line
+    #     per entity per domain; the per voter updates are the strided side, and only touch k voters
+    #   - Each entity's arrays are rebound to row views of these, so per-entity state (sparse_rep, dump_state)
+    #     and the batched kernels read and write the same storage.
+    #   - rows: (total, correct, participation_count) arrays the entities are already rows of (see generate),
+    #     used as they are instead of stacking copies
+    def __init__(self,
+                 entities: list[AnsweringEntity],
+                 cfg: VoterConfig,
+                 rows: Optional[tuple[np.ndarray, np.ndarray, np.ndarray]] = None):
+        self.entities = entities
+        self.cfg = cfg
+        if rows is not None:
+            self.total, self.correct, self.participation_count = rows
+        else:
+            self.total = np.asfortranarray(np.stack([e.total for e in entities]))
+            self.correct = np.asfortranarray(np.stack([e.correct for e in entities]))
+            self.participation_count = np.array([e._participation_count for e in entities], dtype=np.int64)
+            for i, entity in enumerate(entities):
+                entity.total = self.total[i]
+                entity.correct = self.correct[i]
+                entity._participation_count = self.participation_count[i, ...]
+        # Knowledge domains are primary domains, which build_domain_index places first.
+        if any(e._kd_mask >> 64 for e in entities):
+            raise ValueError("Knowledge domain bitmasks only support the first 64 domains")
+        self.kd_mask = np.array([e._kd_mask for e in entities], dtype=np.uint64)
+        # Sigmoid lookup table for this config, and the confidences of the question run_epoch is on
+        self.confidence_table = confidence_table(cfg.c1, cfg.c2)
+        self.confidence = np.zeros(len(entities), dtype=np.float64)
+
+    @classmethod
+    def generate(cls,
+                 domain_list: tuple[str, ...],
+                 domain_to_idx: dict[str, int],
+                 cfg: VoterConfig,
+                 knowledge_idx: np.ndarray,
+                 rng: Optional[np.random.Generator] = None) -> "PopulationArrays":
+        # New population with one entity per row of knowledge_idx (see sample_knowledge_idx)
+        #   - the stacked arrays are allocated once and each entity is built on its rows, instead of every entity
+        #     allocating its own arrays to be copied into the stack
+        population_count = knowledge_idx.shape[0]
+        total = np.zeros((population_count, len(domain_to_idx)), dtype=np.int32, order='F')
+        correct = np.zeros((population_count, len(domain_to_idx)), dtype=np.int32, order='F')
+        participation_count = np.zeros(population_count, dtype=np.int64)
+        entities = [
+            AnsweringEntity(domain_list, domain_to_idx, len(party_knowledge_idx), party_knowledge_idx, rng,
+                            rows=(total[i], correct[i], participation_count[i, ...]))
+            for i, party_knowledge_idx in enumerate(knowledge_idx.tolist())
+        ]
+        return cls(entities, cfg, rows=(total, correct, participation_count))
+
+    def dump_state(self) -> list[dict]:
+        # AnsweringEntity.dump_state for every entity, in order
+        return list(self.iter_state())
+
+    def iter_state(self) -> Iterator[dict]:
+        # dump_state one entity at a time, for streaming saves
+        #   - the nonzero reputation of the whole population is found and converted in one pass over the matrices
+        if not self.entities:
+            return
+        domains = list(self.entities[0]._domain_to_idx)
+        rows, cols = np.nonzero(self.total)
+        # rows is sorted, so each entity's entries are one contiguous run
+        bounds = np.searchsorted(rows, np.arange(len(self.entities) + 1)).tolist()
+        cols_list = cols.tolist()
+        totals = self.total[rows, cols].tolist()
+        corrects = self.correct[rows, cols].tolist()
+        for row, (entity, participation_count) in enumerate(zip(self.entities, self.participation_count.tolist())):
+            yield {
+                "participation_count": participation_count,
+                "reputation": {
+                    domains[cols_list[k]]: (totals[k], corrects[k]) for k in range(bounds[row], bounds[row + 1])
+                },
+                "knowledge_domains": entity.knowledge_domains
+            }
+
+
+class _QuestionColumn:
+
+    # Question attribute stored in a QuestionPool column (see QuestionPool.Question)
+    #   - reads convert the numpy scalar to a python value, and none_value (if given) stands in for None
+    def __init__(self, column: str, convert, none_value=None):
+        self.column = column
+        self.convert = convert
+        self.none_value = none_value
+
+    def __get__(self, question, owner=None):
+        if question is None:
+            return self
+        value = getattr(question._pool, self.column)[question._row]
+        if self.none_value is not None and value == self.none_value:
+            return None
+        return self.convert(value)
+
+    def __set__(self, question, value):
+        getattr(question._pool, self.column)[question._row] = self.none_value if value is None else value
 
 
 class QuestionPool(SimulationEntity):
 
     class Question(SimulationEntity):
-        def __init__(self,
-                     primary: str,
-                     secondary: list[str] = None,
-                     confidence_threshold: float = 50.0,
-                     contention_center: float = 0.7) -> None:
-            self.primary_context = primary
-            self.secondary_context = secondary if secondary is not None else []
-            # PARAMETER: bassline "inverse" contention. ~.5 is high contention, ~1 is low.
-            #   Assign dynamically (default = 0.7): uniform instead? random.uniform(0.51, 0.99)
-            #   Currently: (.5, 1] centered at .7
-            self.contention: int = max(0.51, min(random.gauss(mu=contention_center, sigma=.1), 1))
-            self.true_outcome = random.choice([True, False])
-            # PARAMETER: confidence threshold to be considered answerable
-            #   Assign dynamically: is uniform better? or random.gauss(mu=30, sigma=5.0)?
-            self.req_confidence_theshold: float = confidence_threshold
-            # Result statistics
-            self.aborted = False
-            self.indeterminate_resolution = False
-            self.parties_used: Optional[bool] = None
-            self.resolved_correctly: Optional[bool] = None
+        # View of one row of the QuestionPool columns, the pool owns all question data (struct of arrays)
+        #   - views are cheap and not kept, reads and writes of the attributes below go to the pool's columns
+        #   - only the context index slice is held on the view
+        __slots__ = ('_pool', '_row', 'context_idx')
+
+        # PARAMETER: bassline "inverse" contention. ~.5 is high contention, ~1 is low.
+        #   Assign dynamically (default = 0.7): uniform instead? random.uniform(0.51, 0.99)
+        #   Currently: (.5, 1] centered at .7
+        contention = _QuestionColumn('_contention', float)
+        true_outcome = _QuestionColumn('_true_outcome', bool)
+        # PARAMETER: confidence threshold to be considered answerable
+        #   Assign dynamically: is uniform better? or random.gauss(mu=30, sigma=5.0)?
+        req_confidence_theshold = _QuestionColumn('_req_confidence', float)
+        # Result statistics
+        aborted = _QuestionColumn('_aborted', bool)
+        indeterminate_resolution = _QuestionColumn('_indeterminate_resolution', bool)
+        parties_used = _QuestionColumn('_parties_used', int, none_value=-1)
+        resolved_correctly = _QuestionColumn('_resolved_correctly', bool, none_value=-1)
+
+        def __init__(self, pool: "QuestionPool", row: int) -> None:
+            self._pool = pool
+            self._row = row
+            # Domain indices of all_context (primary first), computed once when the row was added
+            self.context_idx = pool._context_idx[pool._context_start[row]:pool._context_start[row + 1]]
+
+        @property
+        def primary_context(self) -> str:
+            return self._pool._domain_names[self.context_idx[0]]
+
+        @property
+        def secondary_context(self) -> list[str]:
+            return [self._pool._domain_names[i] for i in self.context_idx[1:].tolist()]
 
         @property
         def all_context(self) -> list[str]:
@@ -176,8 +286,7 @@ class QuestionPool(SimulationEntity):
             }
 
         def load_state(self, state_data: dict):
-            self.primary_context = state_data['primary_context']
-            self.secondary_context = state_data['secondary_context']
+            # Context is fixed when the row is added to the pool (see QuestionPool.load_state)
             self.contention = state_data['contention']
             self.true_outcome = state_data['true_outcome']
             self.req_confidence_theshold = state_data['req_confidence']
@@ -186,44 +295,204 @@ class QuestionPool(SimulationEntity):
             self.parties_used = state_data['parties_used']
             self.resolved_correctly = state_data['resolved_correctly']
 
-    def __init__(self, context_set):
-        self.context_set = copy.deepcopy(context_set)
-        self.question_history = []
-
-    def generate_question(self, secondary_count=2, confidence_threshold=50.0, contention_center=0.7) -> Question:
+    # Per question columns and their dtypes, -1 marks None for parties_used and resolved_correctly
+    _COLUMNS = {
+        '_contention': np.float64,
+        '_true_outcome': np.bool_,
+        '_req_confidence': np.float64,
+        '_aborted': np.bool_,
+        '_indeterminate_resolution': np.bool_,
+        '_parties_used': np.int32,
+        '_resolved_correctly': np.int8,
+        # Derived from context, not saved
+        '_ctx_mask64': np.uint64,
+    }
+
+    def __init__(self, context_set, rng: Optional[np.random.Generator] = None):
+        # The context set is only read after construction, so hold a reference instead of a deep copy.
+        #   - callers must not mutate it afterwards, the domain index and choices below are built from it once
+        self.context_set = context_set
+        # Source of all question randomness, pass the simulation's generator to keep runs tied to its seed
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.domain_to_idx = build_domain_index(self.context_set)
+        self._build_domain_choices()
+        self._reset_columns()
+
+    def _reset_columns(self):
+        # Questions are stored as columns, in generation order
+        #   - context is ragged: question i has _context_idx[_context_start[i]:_context_start[i + 1]]
+        #   - columns grow by doubling, only the first _count rows are valid
+        self._count = 0
+        self._context_idx = np.empty(0, dtype=np.intp)
+        self._context_start = np.zeros(1, dtype=np.intp)
+        for column, dtype in self._COLUMNS.items():
+            setattr(self, column, np.empty(0, dtype=dtype))
+
+    def _reserve(self, rows: int, context_size: int):
+        capacity = self._contention.shape[0]
+        if rows > capacity:
+            capacity = max(rows, 2*capacity)
+            for column in self._COLUMNS:
+                old = getattr(self, column)
+                setattr(self, column, np.empty(capacity, dtype=old.dtype))
+                getattr(self, column)[:self._count] = old[:self._count]
+            old_start = self._context_start
+            self._context_start = np.empty(capacity + 1, dtype=np.intp)
+            self._context_start[:self._count + 1] = old_start[:self._count + 1]
+        if context_size > self._context_idx.shape[0]:
+            old_idx = self._context_idx
+            self._context_idx = np.empty(max(context_size, 2*old_idx.shape[0]), dtype=np.intp)
+            self._context_idx[:old_idx.shape[0]] = old_idx
+
+    def reserve(self, question_count: int, secondary_count=2):
+        # Pre-size the columns for question_count more questions, e.g. a whole run, so they never need to grow
+        self._reserve(self._count + question_count,
+                      self._context_start[self._count] + question_count*(1 + secondary_count))
+
+    def _append_rows(self, context_idx, context_lengths, contentions, true_outcomes, confidence_threshold) -> range:
+        # Add questions as rows; context_idx holds every question's domain indices back to back
+        start = self._count
+        end = start + len(context_lengths)
+        context_start = self._context_start[start]
+        context_end = context_start + len(context_idx)
+        self._reserve(end, context_end)
+        self._context_idx[context_start:context_end] = context_idx
+        self._context_start[start + 1:end + 1] = context_start + np.cumsum(context_lengths)
+        # Low 64 bits of every question's context bitmask, OR reduced over each question's domains at once
+        domains = self._context_idx[context_start:context_end].astype(np.uint64)
+        bits = np.where(domains < 64, np.left_shift(np.uint64(1), domains % np.uint64(64)), np.uint64(0))
+        if end > start:
+            self._ctx_mask64[start:end] = np.bitwise_or.reduceat(bits, self._context_start[start:end] - context_start)
+        self._contention[start:end] = contentions
+        self._true_outcome[start:end] = true_outcomes
+        self._req_confidence[start:end] = confidence_threshold
+        self._aborted[start:end] = False
+        self._indeterminate_resolution[start:end] = False
+        self._parties_used[start:end] = -1
+        self._resolved_correctly[start:end] = -1
+        self._count = end
+        return range(start, end)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _build_domain_choices(self):
+        # Choices for primary and per primary secondary domains, built once instead of per question
+        #   - if no sub-collection, secondary domains are picked from the primary domains
+        #   - primary_domains is also where knowledge domains are sampled from
+        self.primary_domains = tuple(self.context_set.keys())
+        self._secondary_keys: dict[str, tuple[str, ...]] = {
+            primary: tuple(sub_collection) if len(sub_collection) != 0 else self.primary_domains
+            for primary, sub_collection in self.context_set.items()
+        }
+        # Domain indices of the same choices, for batched generation (see generate_questions)
+        #   - secondary rows are padded to the longest sub-collection, only the first count entries are valid
+        self._domain_names = list(self.domain_to_idx)
+        self._primary_idx = np.array([self.domain_to_idx[p] for p in self.primary_domains], dtype=np.intp)
+        self._secondary_counts = np.array([len(self._secondary_keys[p]) for p in self.primary_domains], dtype=np.intp)
+        self._secondary_idx = np.zeros((len(self.primary_domains), self._secondary_counts.max()), dtype=np.intp)
+        for row, primary in enumerate(self.primary_domains):
+            self._secondary_idx[row, :self._secondary_counts[row]] = [
+                self.domain_to_idx[d] for d in self._secondary_keys[primary]
+            ]
+
+    def generate_questions(self,
+                           count: int,
+                           secondary_count=2,
+                           confidence_threshold=50.0,
+                           contention_center=0.7) -> range:
         # PARAMETER: secondary_count
         # NOTE: Realistically these will be somewhat biased toward certain domains
+        # Generate count questions at once, e.g. for a whole epoch
+        #   - every random draw for count questions is made up front from the pool's generator
+        #   - context is picked as domain indices, then stored straight into the pool's columns
+        #   - returns the new rows, see Question for a view of one
+        rng = self.rng
         # Select random domains from context lists
-        primary = random.choice(list(self.context_set.keys()))
-        secondary = []
-        for _ in range((secondary_count)):
-            # Pick secondary domains from the sub-collection at the primary domain
-            #   if no sub-collection, pick another primary domain
-            sub_collection = self.context_set.get(primary, {})
-            choice = random.choice(list(sub_collection if len(sub_collection) != 0 else self.context_set.keys()))
-            secondary.append(choice)
-        new_question = QuestionPool.Question(
-            primary=primary,
-            # Assign secondary from nested sublists (after including this full data)!
-            secondary=secondary,
-            confidence_threshold=confidence_threshold,
-            contention_center=contention_center
-        )
+        primary_rows = rng.integers(0, len(self.primary_domains), size=count)
+        # Pick secondary domains from the sub-collection at the primary domain
+        #   if no sub-collection, pick another primary domain
+        secondary_cols = rng.random((count, secondary_count))*self._secondary_counts[primary_rows, None]
+        secondary_cols = secondary_cols.astype(np.intp)
+        context_idx = np.column_stack((self._primary_idx[primary_rows],
+                                       self._secondary_idx[primary_rows[:, None], secondary_cols]))
+        contentions = np.clip(rng.normal(contention_center, .1, size=count), 0.51, 1)
+        true_outcomes = rng.random(count) < 0.5
 
         # Keep questions in order!
-        self.question_history.append(new_question)
-        return new_question
+        return self._append_rows(context_idx.ravel(), np.full(count, 1 + secondary_count),
+                                 contentions, true_outcomes, confidence_threshold)
+
+    def _context_idx_of(self, primary: str, secondary: list[str]) -> np.ndarray:
+        return np.array([self.domain_to_idx[c] for c in (primary, *secondary)], dtype=np.intp)
+
+    @staticmethod
+    def allocate_vote_buffers(n_voters: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Struct of arrays buffers for collected (vote, confidence, stake), sized for the whole population
+        #   - allocated once and sliced per question instead of building a tuple per vote
+        #   - confidences are float64, the dtype population_confidence computes them in, so the tally sees the
+        #     same values selection weighted by
+        votes = np.zeros(n_voters, dtype=np.bool_)
+        confidences = np.zeros(n_voters, dtype=np.float64)
+        stakes = np.zeros(n_voters, dtype=np.int8)
+        return votes, confidences, stakes
+
+    def kernel_columns(self) -> tuple[np.ndarray, ...]:
+        # Context and per question columns in kernels.run_epoch argument order, written in place by it
+        #   - only valid until the columns next grow, reserve up front to keep them
+        return (self._context_start, self._context_idx, self._ctx_mask64, self._contention, self._true_outcome,
+                self._req_confidence, self._aborted, self._indeterminate_resolution, self._parties_used,
+                self._resolved_correctly)
 
     def dump_state(self):
         return {
             "context_set": self.context_set,
-            "question_history": [q.dump_state() for q in self.question_history]
+            "question_history": list(self.iter_question_states())
         }
 
+    def iter_question_states(self) -> Iterator[dict]:
+        # Same per question dicts as Question.dump_state, in order, converted from whole columns at once
+        n = self._count
+        names = self._domain_names
+        starts = self._context_start[:n + 1].tolist()
+        context = [names[i] for i in self._context_idx[:starts[-1]].tolist()]
+        parties_used = self._parties_used[:n].tolist()
+        resolved_correctly = self._resolved_correctly[:n].tolist()
+        for row, (contention, true_outcome, req_confidence, aborted, indeterminate_resolution) in enumerate(
+                zip(self._contention[:n].tolist(), self._true_outcome[:n].tolist(), self._req_confidence[:n].tolist(),
+                    self._aborted[:n].tolist(), self._indeterminate_resolution[:n].tolist())):
+            yield {
+                "primary_context": context[starts[row]],
+                "secondary_context": context[starts[row] + 1:starts[row + 1]],
+                "contention": contention,
+                "true_outcome": true_outcome,
+                "req_confidence": req_confidence,
+                "aborted": aborted,
+                "indeterminate_resolution": indeterminate_resolution,
+                "parties_used": None if parties_used[row] < 0 else parties_used[row],
+                "resolved_correctly": None if resolved_correctly[row] < 0 else bool(resolved_correctly[row])
+            }
+
     def load_state(self, state_data: dict):
         self.context_set = state_data['context_set']
+        self.domain_to_idx = build_domain_index(self.context_set)
+        self._build_domain_choices()
         # Should stay ordered?
-        self.question_history = state_data['question_history']
+        self._reset_columns()
+        history = state_data['question_history']
+        contexts = [self._context_idx_of(q['primary_context'], q['secondary_context']) for q in history]
+        rows = self._append_rows(np.concatenate(contexts) if contexts else np.empty(0, dtype=np.intp),
+                                 [c.shape[0] for c in contexts],
+                                 [q['contention'] for q in history],
+                                 [q['true_outcome'] for q in history],
+                                 [q['req_confidence'] for q in history])
+        results = slice(rows.start, rows.stop)
+        self._aborted[results] = [q['aborted'] for q in history]
+        self._indeterminate_resolution[results] = [q['indeterminate_resolution'] for q in history]
+        self._parties_used[results] = [-1 if q['parties_used'] is None else q['parties_used'] for q in history]
+        self._resolved_correctly[results] = [
+            -1 if q['resolved_correctly'] is None else q['resolved_correctly'] for q in history
+        ]
 
 
 # NOTE: may be unnecessary if they don't own any state.
@@ -4,12 +4,12 @@ import json
 import sys
 import logging
 import datetime
-import random
-import copy
-import math
-# import numpy as np
+import hashlib
+import numpy as np
+import orjson
 
-from .players import AnsweringEntity, QuestionPool
+from .kernels import EPOCH_STATS, run_epoch
+from .players import PopulationArrays, QuestionPool, VoterConfig, sample_knowledge_idx
 
 # Make sure logging gets sent to the screen
 logging.basicConfig(stream=sys.stdout, level=logging.CRITICAL)  # Change to warning for pending implementations
@@ -27,13 +27,75 @@ logger = logging.getLogger(__name__)
 # Data files derived from: https://en.wikipedia.org/wiki/Category:Main_topic_classifications
 
 
+def progress(stats: dict[str, int]) -> dict:
+    # Saved progress summary from the run's stat counters
+    #   - ratios with nothing to count (e.g. every question aborted) are None instead of dividing by zero
+    def ratio(numerator, denominator):
+        return numerator / denominator if denominator else None
+
+    true_positive = stats["true_positive"]
+    false_positive = stats["false_positive"]
+    true_negative = stats["true_negative"]
+    false_negative = stats["false_negative"]
+    return {
+        "total_questions": stats["total_questions"],
+        "total_aborted": stats["total_aborted"],
+        "incorrectly_resolved": stats["incorrectly_resolved"],
+        "indeterminate_resolution": stats["indeterminate_resolution"],
+        "accuracy": ratio(true_positive + true_negative,
+                          true_positive + true_negative + false_positive + false_negative),
+        "precision": ratio(true_positive, true_positive + false_positive),
+        "recall": ratio(true_positive, true_positive + false_negative)
+    }
+
+
+def seed_from_string(random_seed: str) -> int:
+    # 64 bit integer seed for np.random.default_rng from a seed string, stable across runs and python versions
+    return int(hashlib.sha256(random_seed.encode()).hexdigest()[:16], 16)
+
+
+def rng_state(rng: np.random.Generator) -> dict:
+    # JSON safe copy of rng.bit_generator.state, saved so a run can be resumed from the exact draw it stopped at
+    #   - PCG64 state and increment are 128 bit, beyond what JSON encoders take as integers, so they are strings;
+    #     convert them back with int() before assigning to bit_generator.state
+    def encode(value):
+        if isinstance(value, dict):
+            return {key: encode(item) for key, item in value.items()}
+        if isinstance(value, int) and value.bit_length() > 63:
+            return str(value)
+        return value
+
+    return encode(rng.bit_generator.state)
+
+
+def write_state(f, header: dict, population: PopulationArrays, question_pool: QuestionPool):
+    # Stream a saved state as line delimited JSON, one record per line
+    #   - line 1: header (random_seed, rng_state, progress, parameters, answering_entity_count and question_count)
+    #   - then answering_entity_count entity lines, a {"context_set": ...} line, and question_count question lines
+    #   - entities and questions are encoded one at a time as they are generated, so the whole state is never
+    #     built in memory at once
+    #   - orjson encodes in C and can take numpy arrays/scalars directly
+    dumps = orjson.dumps
+    option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_APPEND_NEWLINE
+    f.write(dumps({**header,
+                   "answering_entity_count": len(population.entities),
+                   "question_count": len(question_pool)}, option=option))
+    for entity_state in population.iter_state():
+        f.write(dumps(entity_state, option=option))
+    f.write(dumps({"context_set": question_pool.context_set}, option=option))
+    for question_state in question_pool.iter_question_states():
+        f.write(dumps(question_state, option=option))
+
+
 # Run with: python3.10 -m src.simulation, or similar
 def main():
     # Configure the simulation with arg parser for a default simulation run or given params.
     argparser = argparse.ArgumentParser()
 
     random_seed = datetime.datetime.now().isoformat()
-    random.seed(a=random_seed)
+    # The one numpy generator (PCG64) for all simulation randomness (questions, knowledge domains, selection, votes)
+    #   - seeded from a hash of random_seed so runs stay tied to it
+    rng = np.random.default_rng(seed_from_string(random_seed))
 
     # Load context from full dataset in its own file
     # Note that this file has 2 levels of heirachical knowledge categories.
@@ -51,7 +113,7 @@ def main():
 
     # Reputation model
     argparser.add_argument("--answering_population", help="Count of answering parties", type=int, required=True)
-    argparser.add_argument("--reputation-affinity", help="", type=float, default=10)
+    argparser.add_argument("--reputation-affinity", help="", type=float, default=10.0)
     argparser.add_argument("--rep-c1", help="Reputation growth limit c1", type=float, required=True)
     argparser.add_argument("--rep-c2", help="Reputation growth rate c2", type=float, required=True)
     argparser.add_argument("--use-rep", help="Use reputation weighting", default=False, action="store_true")
@@ -68,6 +130,7 @@ def main():
     argparser.add_argument("--epochs_per_save", help="Count of epochs between saves", type=int, default=1)
     argparser.add_argument("--save_directory", help="Location to save outputs", type=str, default="sim_states")
     argparser.add_argument("--silence_logging", help="Run the sim faster by turning off logging", action="store_true")
+    argparser.add_argument("--pretty", help="Save states as indented JSON for reading", action="store_true")
 
     # Parse inputs
     args = argparser.parse_args()
@@ -75,7 +138,8 @@ def main():
     # PARAMETER
     answering_population_count = args.answering_population  # 100
     # PARAMETER: How strongly do we favor identities with reputation in a questions context
-    reputation_affinity = args.reputation_affinity
+    #   - always a float, so run_epoch only ever compiles one signature
+    reputation_affinity = float(args.reputation_affinity)
     # PARAMETER
     rep_c1 = args.rep_c1
     # PARAMETER
@@ -107,229 +171,147 @@ def main():
     if args.silence_logging:
         # NOTE: only applies for this file, not globally.
         logger.setLevel(logging.WARN)
+    # Per question info logs are checked once here instead of on every call in the question loop
+    #   - the level is fixed for the run, and this also skips evaluating the log arguments
+    log_questions = logger.isEnabledFor(logging.INFO)
 
     # Initialize statistics
-    # - Overall stats
-    total_questions = 0
-    total_aborted = 0
-    true_positive = 0
-    false_positive = 0
-    true_negative = 0
-    false_negative = 0
-    # - Per question stats
-    incorrectly_resolved = 0
-    indeterminate_resolution = 0
+    # - Overall stats, one counter per name, the run_epoch counts are added under EPOCH_STATS
+    stats = dict.fromkeys(("total_questions", "incorrectly_resolved", *EPOCH_STATS), 0)
     # majority_reputation = []
     # minority_reputation = []
 
     # Initialize question pool from context_set
-    question_pool = QuestionPool(context_set=context_set)
-
-    answering_parties = []
-    # Initialize the desired number of answering parties
-    for _ in range(answering_population_count):
-        answering_parties.append(
-            AnsweringEntity(
-                context_set,
-                rep_c1,
-                rep_c2,
-                experience_domains,
-                exp_boost=experience_boost
-            )
-        )
+    question_pool = QuestionPool(context_set=context_set, rng=rng)
+    # Every question of the run is kept, size the pool for all of them up front
+    question_pool.reserve(epochs*questions_per_epoch, secondary_context_count)
+
+    # Primary domains to draw knowledge domains from, shared with the question pool
+    domain_list = question_pool.primary_domains
+    # One shared config for the whole population
+    voter_config = VoterConfig(c1=rep_c1, c2=rep_c2, exp_boost=experience_boost)
+    # Knowledge domains of every answering party, as positions in domain_list, drawn in one batch
+    knowledge_idx = sample_knowledge_idx(rng, answering_population_count, len(domain_list), experience_domains)
+    # Initialize the desired number of answering parties, built straight into the stacked population arrays
+    population = PopulationArrays.generate(domain_list, question_pool.domain_to_idx, voter_config, knowledge_idx, rng)
+    # Reused (vote, confidence, stake) buffers, sliced to the participating voter count per question
+    vote_buffer, confidence_buffer, stake_buffer = question_pool.allocate_vote_buffers(answering_population_count)
+    # Population indices shuffled in place for uniform selection, any permutation is a valid starting point
+    voter_order = np.arange(answering_population_count)
+    # Selected voter indices in selection order
+    selection_buffer = np.empty(answering_population_count, dtype=np.intp)
 
     # Start running epochs
     for epoch_number in range(epochs):
         logger.info("Running epoch #%s", epoch_number)
         # Process the desired number of questions
-        for question_number in range(questions_per_epoch):
-            logger.info("Running question #%s in epoch #%s", question_number, epoch_number)
-            # Generate a question from context
-            this_question: QuestionPool.Question = question_pool.generate_question(secondary_context_count,
-                                                                                   confidence_threshold,
-                                                                                   bassline_contention_center)
-            total_questions += 1
-            #   - Assign the question, q, a bassline contention. [parameter]
-            #   - Assign the question a secret “true” outcome for analysis purposes.
-            #   - Assign a threshold confidence [parameter]
-            logger.info("Generated question with domains %s", this_question)
-
-            # Select who will be voting
-            #   - based on required confidence threshold and current reputation
-            #   - select psuedo randomly weighted by established reputation
-            available_reputation = 0
-            remaining_voters = copy.copy(answering_parties)
-            participating_voters: list[AnsweringEntity] = []
-            # Note: we will interpret this confidence threshold as a minimum common one.
-            #   - A given user may opt to increase important questions at will.
-            #   - EXPERIMENT: Try to evaluate archievable tolerances once high rep is established?
-            if use_reputation:
-                # TODO: speed up this very heavy computation? (relative to the rest) (particularly for 1k / 10k voters)
-                current_rep = [voter.calculate_confidence(this_question.all_context) for voter in answering_parties]
-                # PARAMETER: the sensitivity of this to reputation can vary
-                voter_affinity = [math.floor(i*reputation_affinity) for i in current_rep]
-            else:
-                # Default to constant counts if no reputation (should be same as reputation_affinity = 1)
-                voter_affinity = [1 for _ in range(len(answering_parties))]
-            while (available_reputation < this_question.req_confidence_theshold):
-                if len(remaining_voters) > 0:
-                    # Selection can favor high reputation instead of being uniform via "reputation_affinity"
-                    #   - this will be important for selecting the knowledgeable individuals
-                    #   - note that this favoritism may want to be stronger with larger entity counts!
-                    #   - maybe count=[floor(entity.rep/0.2) for entity in remaining_voters], so high rep occurs more
-                    #   - use random.sample(iterable, COUNTS, k) to adjust distribution
-                    selected_participant: list = random.sample(remaining_voters, counts=voter_affinity, k=1)
-                    selected_participant: AnsweringEntity = selected_participant[0]
-                    # selected_participant: AnsweringEntity = random.choice(remaining_voters)
-                    # Find the list position of the selected voter
-                    voter_pos = remaining_voters.index(selected_participant)
-                    # Remove selected voter from remaining selection
-                    remaining_voters.remove(selected_participant)
-                    # Remove selected voter's affinity from affinity list
-                    voter_affinity.pop(voter_pos)
-                    if use_reputation and not fixed_threshold:
-                        available_reputation += selected_participant.calculate_confidence(this_question.all_context)
-                    else:  # if fixed_threshold or not use_reputation:
-                        # Contributions are counts with a fixed threshodl or reputation disabled
-                        available_reputation += 1
-                    participating_voters.append(selected_participant)
-                else:
-                    # We record aborting this question for statistics below.
+        # Generate the epoch's questions from context in one batch
+        #   - Assign the question, q, a bassline contention. [parameter]
+        #   - Assign the question a secret “true” outcome for analysis purposes.
+        #   - Assign a threshold confidence [parameter]
+        #   - Note: we will interpret this confidence threshold as a minimum common one.
+        #       - A given user may opt to increase important questions at will.
+        #       - EXPERIMENT: Try to evaluate archievable tolerances once high rep is established?
+        epoch_rows = question_pool.generate_questions(questions_per_epoch,
+                                                      secondary_context_count,
+                                                      confidence_threshold,
+                                                      bassline_contention_center)
+        stats["total_questions"] += len(epoch_rows)
+
+        # Run every question of the epoch in one compiled call (see kernels.run_epoch)
+        #   - Select who will be voting, pseudo randomly weighted by established reputation
+        #       - Selection can favor high reputation instead of being uniform via "reputation_affinity"
+        #       - this will be important for selecting the knowledgeable individuals
+        #       - note that this favoritism may want to be stronger with larger entity counts!
+        #       - if we used everyone and can't meet the threshold, the question is aborted.
+        #         Note: it may not be immediately obvious who "everyone" is in a decentralized voting game.
+        #         This cutoff is an approximation for a time bound or a recency heuristic.
+        #   - Allow selected entities to vote; collect votes
+        #       - Each entity has a probability c to vote the “true” outcome [parameter]
+        #         Key: we suppose some entities naturally have a higher probability
+        #         of correctness (due to their knowledge of the context) and we hope
+        #         reputation can be a tool to allow long term system behavior to favor
+        #         this knowledge.
+        #       - Each entity has a particular stake contributed when voting [parameter; these may just be uniform]
+        #   - Compute the _resolved outcome_ based on votes, utilizing reputation weights and stakes
+        #       - NOTE: We can consider adding superlinearity with stake (only relevant if non-uniform voting stake)
+        #   - Regardless of the “true” outcome, reputation is adjusted according to votes and resolved outcome
+        epoch_stats = dict(zip(EPOCH_STATS, run_epoch(rng, epoch_rows.start, epoch_rows.stop,
+                                                      *question_pool.kernel_columns(),
+                                                      population.kd_mask,
+                                                      population.correct,
+                                                      population.total,
+                                                      population.confidence,
+                                                      population.participation_count,
+                                                      voter_config.c1,
+                                                      voter_config.c2,
+                                                      population.confidence_table,
+                                                      voter_config.exp_boost,
+                                                      use_reputation,
+                                                      fixed_threshold,
+                                                      reputation_affinity,
+                                                      voter_order,
+                                                      selection_buffer,
+                                                      vote_buffer,
+                                                      confidence_buffer,
+                                                      stake_buffer)))
+        # Aborted questions are counted apart from indeterminate ones
+        #   (Do we consider an aborted question indeterminate? I say no, bc it wouldn't be accepted)
+        for name, count in epoch_stats.items():
+            stats[name] += count
+        stats["incorrectly_resolved"] += epoch_stats["false_positive"] + epoch_stats["false_negative"]
+        if epoch_stats["indeterminate_resolution"]:
+            # Should be unlikely
+            logger.warning("%s results indeterminate in epoch #%s",
+                           epoch_stats["indeterminate_resolution"], epoch_number)
+        if log_questions:
+            # Per question results, logged from the pool once the epoch has run
+            for question_number, row in enumerate(epoch_rows):
+                this_question = QuestionPool.Question(question_pool, row)
+                logger.info("Ran question #%s with domains %s", question_number, this_question)
+                if this_question.aborted:
                     logger.info("Out of voters! Cannot reach threshold to evaluate this question.")
-                    break  # Don't loop forever, just give up on this question.
-
-            # If we used everyone and can't meet the threshold, record this and abort.
-            #   Note: it may not be immediately obvious who "everyone" is in a decentralized voting game.
-            #   This cutoff is an approximation for a time bound or a recency heuristic.
-            if len(remaining_voters) == 0 and available_reputation < this_question.req_confidence_theshold:
-                # Question aborted
-                # indeterminate_resolution += 1
-                #   (Do we consider an aborted question indeterminate? I say no, bc it wouldn't be accepted)
-                this_question.indeterminate_resolution = True
-                this_question.aborted = True
-                this_question.parties_used = None
-                total_aborted += 1
-                continue  # Aborting this question, so go around.
-            else:
-                this_question.parties_used = len(participating_voters)
-                # participants_utilized.append(len(participating_voters))
-            # Record status of how many parties it took
-            logger.info("Met confidence threshold with %s voters", this_question.parties_used)
-
-            # Allow selected entities to vote; collect votes
-            #   - Each entity has a probability c to vote the “true” outcome [parameter]
-            #       Key: we suppose some entities naturally have a higher probability
-            #       of correctness (due to their knowledge of the context) and we hope
-            #       reputation can be a tool to allow long term system behavior to favor
-            #       this knowledge.
-            #   - Each entity has a particular stake contributed when voting [parameter; these may just be uniform]
-            # Implemention of the resolution algorithm
-            collected_votes: list[tuple[bool, float, float]] = []  # (vote, reputation, stake)
-            for voter in participating_voters:
-                # Collect tuples of vote, reputation, and stake (uniform for now)
-                collected_votes.append(
-                    voter.vote(
-                        this_question.all_context,
-                        this_question.contention,
-                        this_question.true_outcome,
-                        use_reputation
-                        )
-                    )
-
-            cumulative_true_votes = 0
-            cumulative_false_votes = 0
-            resolved_outcome = None
-            for vote in collected_votes:
-                # NOTE: We can consider adding superlinearity with stake (only relevant if non-uniform voting stake)
-                if use_reputation:
-                    # Voting with reputation and stake weighting
-                    if vote[0] is True:
-                        cumulative_true_votes += vote[1]*vote[2]  # Add: f(i) = reputation*stake for each vote
-                    else:  # Vote is Flase
-                        cumulative_false_votes += vote[1]*vote[2]  # Add: reputation*stake for each vote
-                else:
-                    # Only voting with stake (i.e. 1 to 1)
-                    if vote[0] is True:
-                        cumulative_true_votes += vote[2]  # Add: f(i) = stake for each vote
-                    else:  # Vote is Flase
-                        cumulative_false_votes += vote[2]  # Add: stake for each vote
-            # Compute the _resolved outcome_ based on votes, and
-            #  - Utilize reputation weights and stakes to resolve the outcome
-            if (cumulative_true_votes > cumulative_false_votes):
-                resolved_outcome = True
-            elif (cumulative_true_votes < cumulative_false_votes):
-                resolved_outcome = False
-            else:
-                # Record the indeterminate solution result for stats (should be unlikely)
-                indeterminate_resolution += 1
-                this_question.indeterminate_resolution = True
-                logger.warning("Result indeterminate! Continuing to next question...")
-                continue
-
-            # Compute who voted correctly and adjust reputation
-            #   - Regardless of the “true” outcome, adjust reputation according to votes and resolved outcome
-            for voter, vote in zip(participating_voters, collected_votes):
-                voter.update_reputation(vote[0], resolved_outcome, this_question.all_context)
-
-            # Record if resolved outcome is not the presupposed one
-            this_question.resolved_correctly = resolved_outcome is this_question.true_outcome
-            if resolved_outcome is not this_question.true_outcome:
-                incorrectly_resolved += 1
-            # Log correctness stats for precision/recall/accuracy
-            if resolved_outcome is True:
-                if this_question.true_outcome is True:
-                    # Resolved true, actually true.
-                    true_positive += 1
-                else:
-                    # Resolved true, actually false.
-                    false_positive += 1
-            else:
-                if this_question.true_outcome is False:
-                    # Resolved false, actually false.
-                    true_negative += 1
-                else:
-                    # Resolved false, actually true.
-                    false_negative += 1
-            logger.info("Resolved outcome agrees with expected: %s", resolved_outcome is this_question.true_outcome)
-            # END question proceessing
+                    continue
+                # Record status of how many parties it took
+                logger.info("Met confidence threshold with %s voters", this_question.parties_used)
+                if this_question.resolved_correctly is not None:
+                    logger.info("Resolved outcome agrees with expected: %s", this_question.resolved_correctly)
         # Save simulation state
         if epoch_number % epochs_per_save == 0:
-            with open(f"./{save_directory}/{datetime.datetime.now().isoformat()}.json", "x") as f:
-                current_state = {
-                    "random_seed": random_seed,
-                    "progress": {
-                        "total_questions": total_questions,
-                        "total_aborted": total_aborted,
-                        "incorrectly_resolved": incorrectly_resolved,
-                        "indeterminate_resolution": indeterminate_resolution,
-                        "accuracy": (true_positive + true_negative) / (true_positive + true_negative
-                                                                       + false_positive + false_negative),
-                        "precision": (true_positive) / (true_positive + false_positive),
-                        "recall": (true_positive) / (true_positive + false_negative)
-                    },
-                    "parameters": {
-                        "data_file": data_file,
-                        "answering_population_count": answering_population_count,
-                        "experience_domains": experience_domains,
-                        "questions_per_epoch": questions_per_epoch,
-                        "epochs": epochs,
-                        "epochs_per_save": epochs_per_save,
-                        "save_directory": save_directory,
-                        "use_reputation": use_reputation,
-                        "fixed_threshold": fixed_threshold,
-                        "rep_c1": rep_c1,
-                        "rep_c2": rep_c2,
-                        "reputation_affinity": reputation_affinity,
-                        # Additional parameters below.
-                        "bassline_contention_center": bassline_contention_center,
-                        "confidence_threshold": confidence_threshold,
-                        "experience_boost": experience_boost,
-                        "secondary_context_count": secondary_context_count
-                    },
-                    "answering_entites": [e.dump_state() for e in answering_parties],
-                    "question_pool": question_pool.dump_state(),
-                }
-                f.write(json.dumps(current_state, indent=4))
+            current_state = {
+                "random_seed": random_seed,
+                "rng_state": rng_state(rng),
+                "progress": progress(stats),
+                "parameters": {
+                    "data_file": data_file,
+                    "answering_population_count": answering_population_count,
+                    "experience_domains": experience_domains,
+                    "questions_per_epoch": questions_per_epoch,
+                    "epochs": epochs,
+                    "epochs_per_save": epochs_per_save,
+                    "save_directory": save_directory,
+                    "use_reputation": use_reputation,
+                    "fixed_threshold": fixed_threshold,
+                    "rep_c1": rep_c1,
+                    "rep_c2": rep_c2,
+                    "reputation_affinity": reputation_affinity,
+                    # Additional parameters below.
+                    "bassline_contention_center": bassline_contention_center,
+                    "confidence_threshold": confidence_threshold,
+                    "experience_boost": experience_boost,
+                    "secondary_context_count": secondary_context_count
+                },
+            }
+            save_path = f"./{save_directory}/{datetime.datetime.now().isoformat()}"
+            if args.pretty:
+                # One indented document for human inspection, otherwise saves are streamed (see write_state)
+                with open(f"{save_path}.json", "xb") as f:
+                    current_state["answering_entites"] = population.dump_state()
+                    current_state["question_pool"] = question_pool.dump_state()
+                    f.write(orjson.dumps(current_state, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+            else:
+                with open(f"{save_path}.ndjson", "xb") as f:
+                    write_state(f, current_state, population, question_pool)
 
 
 if __name__ == "__main__":